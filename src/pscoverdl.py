@@ -1,12 +1,15 @@
 import os
 import re
 import concurrent.futures
+import pickle
 import yaml
 import json
 from termcolor import colored
 from tqdm import tqdm
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import certifi
 
 PS1_COVERS_URL_DEFAULT = (
@@ -23,225 +26,291 @@ PS2_COVERS_URL_3D = (
     "https://raw.githubusercontent.com/xlenore/ps2-covers/main/covers/3d"
 )
 
+_SERIAL_RE = re.compile(r"(\w{4}-\d{5})")
+
+_RESOURCES_DIR = Path(__file__).resolve().parent / "resources"
+
+
+def _load_name_cache(cache_file, source_mtime):
+    try:
+        with open(cache_file, "rb") as file:
+            cached_mtime, name_list = pickle.load(file)
+        if cached_mtime == source_mtime:
+            return name_list
+    except (OSError, pickle.PickleError, EOFError, ValueError):
+        pass
+    return None
+
+
+def _save_name_cache(cache_file, source_mtime, name_list):
+    try:
+        with open(cache_file, "wb") as file:
+            pickle.dump((source_mtime, name_list), file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+
 
 class BaseCoverDownloader:
-    def __init__(self, cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback=False):
+    # (emulator, cover_type) -> (base URL, file extension)
+    _COVER_TABLE = {
+        ("pcsx2", 0): (PS2_COVERS_URL_DEFAULT, ".jpg"),
+        ("pcsx2", 1): (PS2_COVERS_URL_3D, ".png"),
+        ("duckstation", 0): (PS1_COVERS_URL_DEFAULT, ".jpg"),
+        ("duckstation", 1): (PS1_COVERS_URL_3D, ".png"),
+    }
+
+    def __init__(self, cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback=False, workers=None):
         self.cover_dir = Path(cover_dir)
         self.gamelist_dir = gamelist_dir
         self.cover_type = cover_type
         self.use_ssl = use_ssl
         self.emulator = emulator
         self.fallback = fallback
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 8)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.workers,
+            pool_maxsize=self.workers,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET", "HEAD"],
+            ),
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        self.close()
 
     def get_serial_list(self, gamelist_cache_path, existing_covers):
         if not os.path.exists(gamelist_cache_path):
             print(colored("[ERROR]: gamelist.cache file not found", "red"))
             return []
 
+        serials = set()
         with open(gamelist_cache_path, errors="ignore") as file:
-            regex = re.findall(r"(\w{4}-\d{5})", file.read())
-            serial_list = list(set(regex))
-            print(colored(f"[LOG]: {len(serial_list)} games found", "green"))
-            print(
-                colored(
-                    f"[LOG]: Removing already downloaded covers from queue...", "green"
-                )
-            )
-            serial_list = [
-                game_serial
-                for game_serial in serial_list
-                if game_serial not in existing_covers
-            ]
+            for line in file:
+                serials.update(_SERIAL_RE.findall(line))
 
-            return serial_list
+        print(colored(f"[LOG]: {len(serials)} games found", "green"))
+        print(
+            colored(
+                f"[LOG]: Removing already downloaded covers from queue...", "green"
+            )
+        )
+        return sorted(serials - existing_covers)
 
     def existing_covers(self):
         covers = set()
-        for pattern in ("*.jpg", "*.png"):
-            for filename in self.cover_dir.glob(pattern):
-                covers.add(filename.stem)
-        return list(covers)
+        with os.scandir(self.cover_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith((".jpg", ".png")):
+                    covers.add(os.path.splitext(entry.name)[0])
+        return covers
 
     def serial_to_name(self, name_list, game_serial):
         return name_list.get(game_serial)
 
-    def download_cover(self, url, cover_path):
+    def download_cover(self, url, cover_path, head_check=False):
         try:
             if not self.use_ssl:
                 url = url.replace("https://", "http://")
-            response = requests.get(url, verify=certifi.where())
-            if response.status_code == 200:
-                with open(cover_path, "wb") as file:
-                    file.write(response.content)
-                return True
+            if head_check:
+                head = self._session.head(
+                    url, verify=certifi.where(), timeout=(3.05, 5),
+                    allow_redirects=True,
+                )
+                if head.status_code != 200:
+                    return False
+            with self._session.get(
+                url, verify=certifi.where(), timeout=(3.05, 30), stream=True
+            ) as response:
+                if response.status_code == 200:
+                    # Stream to a temp name so an aborted or truncated body
+                    # never leaves a half-written cover under the real name.
+                    part_path = f"{cover_path}.part"
+                    try:
+                        written = 0
+                        with open(part_path, "wb") as file:
+                            for chunk in response.iter_content(chunk_size=64 * 1024):
+                                written += file.write(chunk)
+                        expected = response.headers.get("Content-Length")
+                        if (
+                            expected is not None
+                            and "Content-Encoding" not in response.headers
+                            and written != int(expected)
+                        ):
+                            return False
+                        os.replace(part_path, cover_path)
+                        return True
+                    finally:
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
         except requests.exceptions.RequestException:
             pass
         return False
 
+    def _run_batch(self, tasks, name_list, desc, label="", head_check=False):
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            future_to_serial = {
+                executor.submit(
+                    self.download_cover, url, cover_path, head_check
+                ): game_serial
+                for url, game_serial, cover_path in tasks
+            }
+
+            for future in tqdm(
+                concurrent.futures.as_completed(future_to_serial),
+                total=len(future_to_serial),
+                desc=desc,
+                unit="cover",
+                ncols=50,
+                bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt}",
+            ):
+                game_serial = future_to_serial[future]
+                game_name = self.serial_to_name(name_list, game_serial)
+
+                if future.result():
+                    tqdm.write(
+                        colored(f"{game_serial} | {game_name}{label}", "green"))
+                else:
+                    failed.append((game_serial, game_name))
+        return failed
+
     def download(self):
         if not self.cover_dir.exists():
             self.cover_dir.mkdir(parents=True)
 
         existing_covers = self.existing_covers()
-        name_list = self.get_name_list()
         serial_list = self.get_serial_list(self.gamelist_dir, existing_covers)
 
-        if self.emulator == "pcsx2":
-            covers_url_default = PS2_COVERS_URL_DEFAULT
-            covers_url_3d = PS2_COVERS_URL_3D
-        elif self.emulator == "duckstation":
-            covers_url_default = PS1_COVERS_URL_DEFAULT
-            covers_url_3d = PS1_COVERS_URL_3D
-        else:
+        if not serial_list:
             print(
-                colored(f"[ERROR]: Invalid emulator: {self.emulator}", "red"))
+                colored(f"[LOG]: All covers have already been downloaded", "green"))
             return
 
-        covers_url = covers_url_default
-        if self.cover_type == 1:
-            covers_url = covers_url_3d
-
-        if self.cover_type == 0:
-            cover_urls = [
-                f"{covers_url}/{game_serial}.jpg"
-                for game_serial in serial_list
-                if game_serial not in existing_covers
-            ]
-        elif self.cover_type == 1:
-            cover_urls = [
-                f"{covers_url}/{game_serial}.png"
-                for game_serial in serial_list
-                if game_serial not in existing_covers
+        try:
+            covers_url, cover_ext = self._COVER_TABLE[
+                (self.emulator, self.cover_type)
             ]
-
-        if not serial_list:
+        except KeyError:
             print(
-                colored(f"[LOG]: All covers have already been downloaded", "green"))
+                colored(f"[ERROR]: Invalid emulator: {self.emulator}", "red"))
             return
 
-        workers = 4
-        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            results = []
-            for url in cover_urls:
-                cover_path = self.cover_dir.joinpath(Path(url).name)
-                results.append(executor.submit(
-                    self.download_cover, url, cover_path))
-
-            failed = []
-            for result, url in tqdm(
-                zip(results, cover_urls),
-                total=len(cover_urls),
-                desc="Downloading covers",
-                unit="cover",
-                ncols=50,
-                bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt}",
-            ):
-                game_serial = Path(url).stem
-                game_name = self.serial_to_name(name_list, game_serial)
+        tasks = [
+            (
+                f"{covers_url}/{game_serial}{cover_ext}",
+                game_serial,
+                self.cover_dir / f"{game_serial}{cover_ext}",
+            )
+            for game_serial in serial_list
+        ]
 
-                if result.result():
-                    tqdm.write(
-                        colored(f"{game_serial} | {game_name}", "green"))
-                else:
-                    failed.append((game_serial, game_name))
+        name_list = self.get_name_list()
+        failed = self._run_batch(tasks, name_list, "Downloading covers")
 
         if failed and self.fallback:
-            if self.cover_type == 1:
-                fallback_url_base = covers_url_default
-                fallback_ext = ".jpg"
-            else:
-                fallback_url_base = covers_url_3d
-                fallback_ext = ".png"
-
-            fallback_urls = [
-                f"{fallback_url_base}/{serial}{fallback_ext}"
+            fallback_url_base, fallback_ext = self._COVER_TABLE[
+                (self.emulator, 1 - self.cover_type)
+            ]
+
+            fallback_tasks = [
+                (
+                    f"{fallback_url_base}/{serial}{fallback_ext}",
+                    serial,
+                    self.cover_dir / f"{serial}{fallback_ext}",
+                )
                 for serial, _ in failed
             ]
+            failed = self._run_batch(
+                fallback_tasks,
+                name_list,
+                "Downloading fallbacks",
+                label=" (fallback)",
+                head_check=True,
+            )
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as fallback_executor:
-                fallback_results = []
-                for fb_url in fallback_urls:
-                    cover_path = self.cover_dir.joinpath(Path(fb_url).name)
-                    fallback_results.append(fallback_executor.submit(self.download_cover, fb_url, cover_path))
-
-                for fb_result, (serial, name) in tqdm(
-                    zip(fallback_results, failed),
-                    total=len(failed),
-                    desc="Downloading fallbacks",
-                    unit="cover",
-                    ncols=50,
-                    bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt}",
-                ):
-                    if fb_result.result():
-                        tqdm.write(colored(f"{serial} | {name} (fallback)", "green"))
-                    else:
-                        tqdm.write(
-                            colored(
-                                f"[{serial} | {name}] not found. Skipping...", "yellow"
-                            )
-                        )
-        elif failed:
-            for serial, name in failed:
-                print(colored(f"[{serial} | {name}] not found. Skipping...", "yellow"))
+        for serial, name in failed:
+            print(colored(f"[{serial} | {name}] not found. Skipping...", "yellow"))
 
 
 class PCSX2CoverDownloader(BaseCoverDownloader):
-    def __init__(self, cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback=False):
-        super().__init__(cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback)
+    def __init__(self, cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback=False, workers=None):
+        super().__init__(cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback, workers)
 
     def get_name_list(self):
         name_list = {}
 
-        gameindex_file = (
-            Path(__file__).resolve().parent.joinpath(
-                "resources", "GameIndex.yaml")
-        )
+        gameindex_file = _RESOURCES_DIR / "GameIndex.yaml"
 
         if not gameindex_file.exists():
             print(colored("[ERROR]: GameIndex.yaml file not found", "red"))
             return {}
 
+        cache_file = gameindex_file.with_suffix(".pickle")
+        source_mtime = os.path.getmtime(gameindex_file)
+        name_list = _load_name_cache(cache_file, source_mtime)
+        if name_list is not None:
+            return name_list
+
         with open(gameindex_file, encoding="utf-8-sig") as file:
             name_list = {
                 key: value["name"]
                 for key, value in yaml.load(file, Loader=yaml.CBaseLoader).items()
             }
+        _save_name_cache(cache_file, source_mtime, name_list)
         return name_list
 
 
 class DuckStationCoverDownloader(BaseCoverDownloader):
-    def __init__(self, cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback=False):
-        super().__init__(cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback)
+    def __init__(self, cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback=False, workers=None):
+        super().__init__(cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback, workers)
 
     def get_name_list(self):
         name_list = {}
 
-        gamedb_file = (
-            Path(__file__).resolve().parent.joinpath(
-                "resources", "gamedb.json")
-        )
+        gamedb_file = _RESOURCES_DIR / "gamedb.json"
 
         if not gamedb_file.exists():
             print(colored("[ERROR]: gamedb.json file not found", "red"))
             return {}
 
-        with open(gamedb_file, encoding="utf-8") as file:
-            gameindex = json.load(file)
-            name_list = {item["serial"]: item["name"] for item in gameindex}
+        cache_file = gamedb_file.with_suffix(".pickle")
+        source_mtime = os.path.getmtime(gamedb_file)
+        name_list = _load_name_cache(cache_file, source_mtime)
+        if name_list is not None:
+            return name_list
+
+        gameindex = json.loads(gamedb_file.read_bytes())
+        name_list = {item["serial"]: item["name"] for item in gameindex}
+        _save_name_cache(cache_file, source_mtime, name_list)
         return name_list
 
 
-def download_covers(cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback=False):
+def download_covers(cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback=False, workers=None):
     if emulator == "pcsx2":
-        downloader = PCSX2CoverDownloader(
-            cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback
-        )
+        downloader_cls = PCSX2CoverDownloader
     elif emulator == "duckstation":
-        downloader = DuckStationCoverDownloader(
-            cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback
-        )
+        downloader_cls = DuckStationCoverDownloader
     else:
         print(colored(f"[ERROR]: Invalid emulator: {emulator}", "red"))
         return
 
-    downloader.download()
+    with downloader_cls(
+        cover_dir, gamelist_dir, cover_type, use_ssl, emulator, fallback, workers
+    ) as downloader:
+        downloader.download()